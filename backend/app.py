@@ -1,12 +1,19 @@
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 from flask_pymongo import PyMongo
+from pymongo import ReturnDocument
 from bson.objectid import ObjectId
 import os
 import logging
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.middleware.proxy_fix import ProxyFix
 import uuid
+import atexit
+from recommendations import RecommendationIndex
+from cart_buffer import CartWriteBuffer, COALESCING_ENABLED
+from ratelimit import (LoadShedder, MemoryBucketStore, MongoBucketStore, MongoConcurrencyLimiter,
+                       MAX_IN_FLIGHT, MAX_QUEUE, QUEUE_TIMEOUT, user_from_body, user_from_args, email_from_body)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -36,6 +43,38 @@ except Exception as e:
     logger.error(f"Failed to connect to MongoDB Atlas: {str(e)}")
     raise
 
+# Trust X-Forwarded-For from this many proxies so per-IP limits see the client address
+proxy_hops = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if proxy_hops:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops)
+
+# Admission control: per-user/per-IP token buckets and a concurrency limit.
+# RATE_LIMIT_BACKEND=mongo shares both between workers; "memory" keeps them per process,
+# where the concurrency limit only has an effect with threaded (gthread) workers.
+if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'mongo':
+    bucket_store = MongoBucketStore(mongo.db.rate_limits)
+    concurrency = MongoConcurrencyLimiter(mongo.db.load_shed_slots, MAX_IN_FLIGHT, MAX_QUEUE, QUEUE_TIMEOUT)
+else:
+    bucket_store = MemoryBucketStore()
+    concurrency = None
+limiter = LoadShedder(bucket_store, concurrency)
+limiter.init_app(app)
+
+# "Frequently bought together" lists: built by `python recommendations.py build`,
+# each worker only loads the saved snapshot
+recommender = RecommendationIndex(mongo.db.recommendations)
+recommender.start()
+
+# Optional write coalescing for cart quantity changes (CART_WRITE_COALESCING=1)
+cart_buffer = None
+if COALESCING_ENABLED:
+    cart_buffer = CartWriteBuffer(cart_collection, products_collection)
+    cart_buffer.start()
+    atexit.register(cart_buffer.close)
+
+# Guest-cart sync ids remembered per cart, so a replayed login merge is not added twice
+SYNC_ID_HISTORY = 20
+
 # Configure upload folder for product images
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
@@ -71,6 +110,7 @@ def handle_errors(func):
 # **User Registration**
 @app.route('/api/auth/register', methods=['POST'])
 @handle_errors
+@limiter.limit(user_key=email_from_body, user_rate=0.5, user_burst=5)
 def register():
     data = request.json
     if not data.get("name") or not data.get("username") or not data.get("email") or not data.get("mobile") or not data.get("password"):
@@ -100,6 +140,7 @@ def register():
 # **User Login**
 @app.route('/api/auth/login', methods=['POST'])
 @handle_errors
+@limiter.limit(user_key=email_from_body, user_rate=0.5, user_burst=5)
 def login():
     data = request.json
     email = data.get("email")
@@ -149,6 +190,7 @@ def login():
 # Products endpoints
 @app.route('/api/products', methods=['GET'])
 @handle_errors
+@limiter.limit()
 def get_products():
     products = list(products_collection.find())
     for product in products:
@@ -157,6 +199,7 @@ def get_products():
 
 @app.route('/api/products', methods=['POST'])
 @handle_errors
+@limiter.limit()
 def add_product():
     # Check for token
     token = verify_token()
@@ -191,6 +234,7 @@ def add_product():
 
 @app.route('/api/products/<product_id>', methods=['DELETE'])
 @handle_errors
+@limiter.limit()
 def delete_product(product_id):
     # Check for token
     token = verify_token()
@@ -202,18 +246,40 @@ def delete_product(product_id):
         if result.deleted_count == 0:
             return jsonify({"success": False, "error": "Product not found"}), 404
 
+        if cart_buffer:
+            cart_buffer.discard_product(product_id)
         cart_collection.update_many(
-            {},
-            {"$pull": {"items": {"product._id": product_id}}}
+            {"items.product._id": product_id},
+            {"$pull": {"items": {"product._id": product_id}}, "$inc": {"revision": 1}}
         )
+        recommender.discard(product_id)
 
         return jsonify({"success": True, "message": "Product deleted successfully"}), 200
     except Exception as e:
         return jsonify({"success": False, "error": f"Invalid product ID format: {str(e)}"}), 400
 
+@app.route('/api/products/<product_id>/recommendations', methods=['GET'])
+@handle_errors
+@limiter.limit()
+def get_recommendations(product_id):
+    try:
+        limit = int(request.args.get('limit', recommender.top_k))
+    except ValueError:
+        return jsonify({"success": False, "error": "Limit must be a valid number"}), 400
+    if limit <= 0:
+        return jsonify({"success": False, "error": "Limit must be greater than 0"}), 400
+
+    # Served from the in-memory index; the carts collection is never queried here
+    return jsonify({
+        "success": True,
+        "product_id": product_id,
+        "recommendations": recommender.get(product_id, limit)
+    }), 200
+
 # New endpoint for image upload
 @app.route('/api/upload', methods=['POST'])
 @handle_errors
+@limiter.limit(ip_rate=1, ip_burst=5)
 def upload_file():
     # Check for token
     token = verify_token()
@@ -252,6 +318,7 @@ def upload_file():
 # Cart endpoints
 @app.route('/api/cart', methods=['GET'])
 @handle_errors
+@limiter.limit(user_key=user_from_args)
 def get_cart():
     # Check for token
     token = verify_token()
@@ -276,6 +343,7 @@ def get_cart():
 
 @app.route('/api/cart/add', methods=['POST'])
 @handle_errors
+@limiter.limit(user_key=user_from_body)
 def add_to_cart():
     # Check for token
     token = verify_token()
@@ -305,6 +373,7 @@ def add_to_cart():
 
 @app.route('/api/cart/remove', methods=['POST'])
 @handle_errors
+@limiter.limit(user_key=user_from_body)
 def remove_from_cart():
     # Check for token
     token = verify_token()
@@ -332,6 +401,7 @@ def remove_from_cart():
 
 @app.route('/api/cart/clear', methods=['POST'])
 @handle_errors
+@limiter.limit(user_key=user_from_body)
 def clear_cart():
     # Check for token
     token = verify_token()
@@ -354,6 +424,60 @@ def clear_cart():
     
     return jsonify({"success": True, "message": "Cart cleared successfully", "cart": updated_cart}), 200
 
+# Load shedding metrics
+@app.route('/api/metrics/load-shedding', methods=['GET'])
+@handle_errors
+def load_shedding_metrics():
+    return jsonify({"success": True, "metrics": limiter.stats()}), 200
+
+# Cart write coalescing metrics
+@app.route('/api/metrics/cart-writes', methods=['GET'])
+@handle_errors
+def cart_write_metrics():
+    if not cart_buffer:
+        return jsonify({"success": True, "enabled": False}), 200
+    return jsonify({"success": True, "enabled": True, "metrics": dict(cart_buffer.stats)}), 200
+
+@app.route('/api/cart/sync', methods=['POST'])
+@handle_errors
+@limiter.limit(user_key=user_from_body)
+def sync_cart():
+    # Check for token
+    token = verify_token()
+    if not token:
+        return jsonify({"success": False, "error": "Authentication required"}), 401
+    
+    data = request.json
+    user_id = data.get('user_id')
+    revision = data.get('revision')
+    merge = data.get('merge') or 'max'
+    sync_id = data.get('sync_id')
+    
+    # Validate required fields
+    if not user_id:
+        return jsonify({"success": False, "error": "User ID is required"}), 400
+    if revision is not None and (not isinstance(revision, int) or isinstance(revision, bool)):
+        return jsonify({"success": False, "error": "Revision must be an integer"}), 400
+    if merge not in ('max', 'sum'):
+        return jsonify({"success": False, "error": "Merge must be 'max' or 'sum'"}), 400
+    if sync_id is not None and (not isinstance(sync_id, str) or not sync_id):
+        return jsonify({"success": False, "error": "Sync ID must be a non-empty string"}), 400
+    
+    # Collapse the client's lines into product_id -> quantity
+    client_items = {}
+    for line in data.get('items') or []:
+        product_id = line.get('product_id') if isinstance(line, dict) else None
+        quantity = line.get('quantity') if isinstance(line, dict) else None
+        if not product_id or not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            return jsonify({"success": False, "error": "Each item needs a product_id and a positive integer quantity"}), 400
+        client_items[product_id] = client_items.get(product_id, 0) + quantity
+    
+    delta = Cart.sync(user_id, client_items, revision, merge, sync_id)
+    if delta is None:
+        return jsonify({"success": False, "error": "Cart changed during sync, please retry"}), 409
+    
+    return jsonify({"success": True, **delta}), 200
+
 # Serve uploaded files
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
@@ -364,10 +488,18 @@ def uploaded_file(filename):
 class Cart:
     @staticmethod
     def get_cart(user_id):
+        # With write coalescing on, serve the cached cart with pending changes applied
+        if cart_buffer:
+            return cart_buffer.get_cart(user_id, Cart._load_cart)
+        return Cart._load_cart(user_id)
+
+    @staticmethod
+    def _load_cart(user_id):
         # Find cart for user or create a new one if it doesn't exist
-        cart = cart_collection.find_one({"user_id": user_id})
+        # (flush_ids and sync_ids are write bookkeeping, not part of the cart)
+        cart = cart_collection.find_one({"user_id": user_id}, {"flush_ids": 0, "sync_ids": 0})
         if not cart:
-            cart = {"user_id": user_id, "items": []}
+            cart = {"user_id": user_id, "items": [], "revision": 0}
             cart_collection.insert_one(cart)
         
         # Convert ObjectIds to strings for all products in items
@@ -380,6 +512,16 @@ class Cart:
     @staticmethod
     def add_item(product_id, user_id):
         try:
+            if cart_buffer:
+                # Only look the product up when it is not in the cart yet
+                product = None
+                if not cart_buffer.has_item(user_id, product_id, Cart._load_cart):
+                    product = products_collection.find_one({"_id": ObjectId(product_id)})
+                    if not product:
+                        return None
+                    product["_id"] = str(product["_id"])
+                return cart_buffer.add(user_id, product_id, 1, Cart._load_cart, product)
+
             # Find the product
             product = products_collection.find_one({"_id": ObjectId(product_id)})
             if not product:
@@ -391,7 +533,7 @@ class Cart:
             # Get or create user's cart
             cart = cart_collection.find_one({"user_id": user_id})
             if not cart:
-                cart = {"user_id": user_id, "items": []}
+                cart = {"user_id": user_id, "items": [], "revision": 0}
                 cart_collection.insert_one(cart)
             
             # Check if product already exists in cart
@@ -410,7 +552,7 @@ class Cart:
             # Update cart in database
             cart_collection.update_one(
                 {"user_id": user_id},
-                {"$set": {"items": cart["items"]}}
+                {"$set": {"items": cart["items"]}, "$inc": {"revision": 1}}
             )
             
             return Cart.get_cart(user_id)
@@ -422,6 +564,9 @@ class Cart:
     @staticmethod
     def remove_item(product_id, user_id):
         try:
+            if cart_buffer:
+                return cart_buffer.add(user_id, product_id, -1, Cart._load_cart)
+
             # Get user's cart
             cart = cart_collection.find_one({"user_id": user_id})
             if not cart:
@@ -441,7 +586,7 @@ class Cart:
             # Update cart in database
             cart_collection.update_one(
                 {"user_id": user_id},
-                {"$set": {"items": cart["items"]}}
+                {"$set": {"items": cart["items"]}, "$inc": {"revision": 1}}
             )
             
             return Cart.get_cart(user_id)
@@ -453,17 +598,104 @@ class Cart:
     @staticmethod
     def clear_cart(user_id):
         try:
+            # Pending quantity changes must not resurrect cleared items
+            if cart_buffer:
+                cart_buffer.discard_user(user_id)
+
             # Update cart with empty items array
-            cart_collection.update_one(
+            cart = cart_collection.find_one_and_update(
                 {"user_id": user_id},
-                {"$set": {"items": []}}
+                {"$set": {"items": []}, "$inc": {"revision": 1}},
+                projection={"revision": 1},
+                return_document=ReturnDocument.AFTER
             )
             
-            return {"user_id": user_id, "items": []}
+            return {"user_id": user_id, "items": [], "revision": cart["revision"] if cart else 0}
             
         except Exception as e:
             logger.error(f"Error clearing cart: {str(e)}")
             return {"user_id": user_id, "items": []}
 
+    @staticmethod
+    def sync(user_id, client_items, revision, merge="max", sync_id=None):
+        """Merge a client-side cart into the stored cart in one conditional write.
+
+        If the client saw the current revision its cart wins outright.
+        Otherwise lines are unioned: merge="max" keeps the larger quantity
+        (a stale copy of this same cart), merge="sum" adds the client's
+        quantities (a guest cart merged at login). A sync_id that the cart
+        already took is not applied again, so a replayed sum never
+        double-counts. Returns the lines that differ from what the client
+        sent, or None if the cart kept changing underneath us.
+        """
+        if not cart_buffer:
+            return Cart._sync(user_id, client_items, revision, merge, sync_id)
+        # Write the user's buffered clicks and hold new ones until the merge is stored
+        with cart_buffer.hold(user_id):
+            return Cart._sync(user_id, client_items, revision, merge, sync_id)
+
+    @staticmethod
+    def _sync(user_id, client_items, revision, merge, sync_id):
+        products = {}
+        for attempt in range(3):
+            cart = Cart._load_cart(user_id)
+            current_revision = cart.get("revision", 0)
+            server_items = {item["product"]["_id"]: item for item in cart.get("items", [])}
+            applied = sync_id is not None and cart_collection.find_one(
+                {"user_id": user_id, "sync_ids": sync_id}, {"_id": 1}
+            ) is not None
+
+            if applied:
+                # A replay of a sync the cart already took: only report the delta
+                quantities = {pid: item["quantity"] for pid, item in server_items.items()}
+            elif revision == current_revision:
+                quantities = dict(client_items)
+            else:
+                quantities = {pid: item["quantity"] for pid, item in server_items.items()}
+                for pid, quantity in client_items.items():
+                    if merge == "sum":
+                        quantities[pid] = quantities.get(pid, 0) + quantity
+                    else:
+                        quantities[pid] = max(quantity, quantities.get(pid, 0))
+
+            # Product documents for lines the stored cart does not have yet
+            missing = [pid for pid in quantities if pid not in server_items and pid not in products and ObjectId.is_valid(pid)]
+            if missing:
+                for product in products_collection.find({"_id": {"$in": [ObjectId(pid) for pid in missing]}}):
+                    product["_id"] = str(product["_id"])
+                    products[product["_id"]] = product
+
+            items = []
+            for pid, item in server_items.items():
+                if pid in quantities:
+                    items.append({"product": item["product"], "quantity": quantities[pid]})
+            for pid, quantity in quantities.items():
+                if pid not in server_items and pid in products:
+                    items.append({"product": products[pid], "quantity": quantity})
+
+            new_revision = current_revision
+            if items != cart.get("items", []) or (sync_id is not None and not applied):
+                new_revision = current_revision + 1
+                update = {"$set": {"items": items, "revision": new_revision}}
+                if sync_id is not None:
+                    # Remember the sync so a replay is recognised
+                    update["$push"] = {"sync_ids": {"$each": [sync_id], "$slice": -SYNC_ID_HISTORY}}
+                result = cart_collection.update_one(
+                    {"user_id": user_id, "revision": cart.get("revision")},
+                    update
+                )
+                if result.matched_count == 0:
+                    continue
+
+            # Delta against the client's copy: changed or added lines, and removed ids
+            merged = {item["product"]["_id"]: item for item in items}
+            return {
+                "revision": new_revision,
+                "changed": [item for pid, item in merged.items() if client_items.get(pid) != item["quantity"]],
+                "removed": [pid for pid in client_items if pid not in merged]
+            }
+
+        return None
+
 if __name__ == "__main__":
     app.run(debug=True)
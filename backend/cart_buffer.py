@@ -0,0 +1,361 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Write coalescing settings (off unless CART_WRITE_COALESCING=1)
+COALESCING_ENABLED = os.getenv('CART_WRITE_COALESCING', '0') == '1'
+WINDOW_SECONDS = float(os.getenv('CART_COALESCE_WINDOW_MS', '500')) / 1000
+JOURNAL_PATH = os.getenv('CART_COALESCE_JOURNAL', 'cart_pending.json')
+
+# Flush ids remembered per cart so a retried write is never applied twice
+FLUSH_ID_HISTORY = 20
+
+# A write is retried at most this many times before it is dropped
+MAX_FLUSH_ATTEMPTS = 5
+
+# Server error codes that mean "try again later" (primary stepdown, shutdown,
+# network trouble, write conflicts); any other write error is permanent
+RETRYABLE_CODES = {6, 7, 64, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+
+class CartWriteBuffer:
+    """Merges cart quantity changes in memory and flushes them as one bulk write.
+
+    Each (user, product) pair keeps a net quantity delta, written once it is
+    older than the coalescing window. Every user's deltas become a single
+    update that Mongo applies to the stored cart, so writes from other
+    workers are merged rather than overwritten. A worker keeps a copy of a
+    cart, with its deltas applied, only while it has unwritten deltas for
+    that user; every other read goes to Mongo.
+
+    Each write carries a flush id that the cart remembers, so a write whose
+    outcome is unknown can be retried safely. Transient failures are retried
+    up to MAX_FLUSH_ATTEMPTS times; permanent ones (e.g. document validation)
+    are logged and dropped. Anything still unwritten on shutdown is saved to
+    a journal file and replayed on the next start.
+    """
+
+    def __init__(self, collection, products_collection, window=WINDOW_SECONDS, journal_path=JOURNAL_PATH):
+        self.collection = collection
+        self.products_collection = products_collection
+        self.window = window
+        self.journal_path = journal_path
+        self._pending = {}      # user_id -> {product_id: {"delta": int, "product": dict}}
+        self._first_seen = {}   # user_id -> time of the oldest pending delta
+        self._retry = []        # [(user_id, flush_id, deltas, attempts)] writes to repeat as-is
+        self._carts = {}        # user_id -> cart view, only while it has unwritten deltas
+        self._flushing = Counter()  # user_id -> flushes writing that user's deltas right now
+        self._held = set()      # users whose writes are paused, see hold()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"deltas_buffered": 0, "bulk_writes": 0, "failed_writes": 0, "dropped_writes": 0}
+
+    def get_cart(self, user_id, load_cart):
+        """The user's cart with this worker's unwritten deltas applied"""
+        with self._cond:
+            if user_id in self._carts:
+                return copy.deepcopy(self._carts[user_id])
+
+        cart = load_cart(user_id)
+        with self._cond:
+            # A concurrent write may have started a view while we were loading
+            if user_id in self._carts:
+                return copy.deepcopy(self._carts[user_id])
+            # Deltas replayed from the journal are not in the stored cart yet
+            if self._has_writes(user_id) and user_id not in self._flushing:
+                for deltas in self._unwritten(user_id):
+                    for product_id, entry in deltas.items():
+                        self._apply(cart, product_id, entry["delta"], entry["product"])
+                self._carts[user_id] = cart
+            return copy.deepcopy(cart)
+
+    def add(self, user_id, product_id, delta, load_cart, product=None):
+        """Buffer a quantity change and return the updated cart.
+
+        product is the product document, needed only when the item is not
+        already in the cart. Decrements of items that are not in the cart
+        are ignored, matching Cart.remove_item.
+        """
+        while True:
+            view = self.get_cart(user_id, load_cart)
+            with self._cond:
+                if user_id in self._held:
+                    # The cart is being rewritten; wait, then start again from the new cart
+                    self._cond.wait_for(lambda: user_id not in self._held)
+                    continue
+                cart = self._carts.setdefault(user_id, view)
+                entry = self._pending.get(user_id, {}).get(product_id)
+                product = product or (entry and entry["product"])
+
+                delta = self._apply(cart, product_id, delta, product)
+                if delta:
+                    entry = self._pending.setdefault(user_id, {}).setdefault(product_id, {"delta": 0, "product": product})
+                    entry["delta"] += delta
+                    entry["product"] = entry["product"] or product
+                    self._first_seen.setdefault(user_id, time.time())
+                    self.stats["deltas_buffered"] += 1
+                elif not self._has_writes(user_id):
+                    del self._carts[user_id]
+                return copy.deepcopy(cart)
+
+    def has_item(self, user_id, product_id, load_cart):
+        """Whether the (buffered) cart already holds the product"""
+        cart = self.get_cart(user_id, load_cart)
+        return any(item["product"]["_id"] == product_id for item in cart.get("items", []))
+
+    def flush(self, user_ids=None):
+        """Write due deltas (or all deltas of user_ids) to the carts collection in one bulk write.
+
+        With user_ids, only those users' earlier failed writes are retried,
+        so one user's failure never surfaces in another user's flush. Raises
+        if a write failed and was queued for retry.
+        """
+        with self._cond:
+            now = time.time()
+            if user_ids is None:
+                user_ids = [u for u, seen in self._first_seen.items() if now - seen >= self.window]
+                entries, self._retry = self._retry, []
+            else:
+                entries = [entry for entry in self._retry if entry[0] in user_ids]
+                self._retry = [entry for entry in self._retry if entry[0] not in user_ids]
+            # Earlier failed writes go first, with their original flush ids
+            flush_id = uuid.uuid4().hex
+            for user_id in user_ids:
+                if user_id in self._pending:
+                    entries.append((user_id, flush_id, self._pending.pop(user_id), 0))
+                    self._first_seen.pop(user_id, None)
+            users = {user_id for user_id, _, _, _ in entries}
+            self._flushing.update(users)
+
+        failed, dropped, error = [], [], None
+        try:
+            entries = self._without_deleted_products(entries)
+            if entries:
+                self.collection.bulk_write(
+                    [self._operation(user_id, fid, deltas) for user_id, fid, deltas, _ in entries],
+                    ordered=False
+                )
+                self.stats["bulk_writes"] += 1
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                # Writes may or may not have landed; the flush ids make retrying all of it safe
+                failed = entries
+            else:
+                # Every write is one user's cart, so exactly the reported ones were not applied
+                codes = {write_error["index"]: write_error.get("code") for write_error in e.details["writeErrors"]}
+                failed = [entry for i, entry in enumerate(entries) if codes.get(i) in RETRYABLE_CODES]
+                dropped = [entry for i, entry in enumerate(entries) if i in codes and codes[i] not in RETRYABLE_CODES]
+            error = e
+        except Exception as e:
+            if self._is_retryable(e):
+                # Outcome unknown; the flush ids make retrying all of it safe
+                failed = entries
+            else:
+                dropped = entries
+            error = e
+
+        failed = [(user_id, fid, deltas, attempts + 1) for user_id, fid, deltas, attempts in failed]
+        dropped += [entry for entry in failed if entry[3] >= MAX_FLUSH_ATTEMPTS]
+        failed = [entry for entry in failed if entry[3] < MAX_FLUSH_ATTEMPTS]
+
+        with self._cond:
+            self._retry = failed + self._retry
+            self._flushing.subtract(users)
+            self._flushing += Counter()  # drop users with no flush left
+            for user_id in users:
+                if not self._has_writes(user_id):
+                    self._carts.pop(user_id, None)
+            self._cond.notify_all()
+
+        for user_id, _, deltas, _ in dropped:
+            self.stats["dropped_writes"] += 1
+            changes = {pid: entry["delta"] for pid, entry in deltas.items()}
+            logger.error(f"Dropped buffered cart writes {changes} for user {user_id}: {str(error)}")
+        if failed:
+            self.stats["failed_writes"] += 1
+            logger.error(f"Error flushing buffered cart writes for {len(failed)} users: {str(error)}")
+            raise error
+
+    @contextmanager
+    def hold(self, user_id):
+        """Flush a user's writes and pause new ones while the caller rewrites the stored cart"""
+        with self._cond:
+            self._cond.wait_for(lambda: user_id not in self._held)
+            self._held.add(user_id)
+            # Let a background flush of this user finish, so its outcome is known
+            self._cond.wait_for(lambda: user_id not in self._flushing)
+        try:
+            self.flush([user_id])
+            yield
+        finally:
+            with self._cond:
+                self._held.discard(user_id)
+                # The view predates the rewrite; the next read rebuilds it from Mongo
+                self._carts.pop(user_id, None)
+                self._cond.notify_all()
+
+    def discard_user(self, user_id):
+        """Drop a user's buffered deltas and cart view (before the cart is overwritten)"""
+        with self._cond:
+            self._cond.wait_for(lambda: user_id not in self._flushing)
+            self._pending.pop(user_id, None)
+            self._first_seen.pop(user_id, None)
+            self._retry = [entry for entry in self._retry if entry[0] != user_id]
+            self._carts.pop(user_id, None)
+
+    def discard_product(self, product_id):
+        """Drop a deleted product from every buffered delta and cart view"""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._flushing)
+            for deltas in list(self._pending.values()) + [deltas for _, _, deltas, _ in self._retry]:
+                deltas.pop(product_id, None)
+            for user_id in [u for u, deltas in self._pending.items() if not deltas]:
+                del self._pending[user_id]
+                self._first_seen.pop(user_id, None)
+            self._retry = [entry for entry in self._retry if entry[2]]
+            for user_id in list(self._carts):
+                if not self._has_writes(user_id):
+                    del self._carts[user_id]
+                    continue
+                cart = self._carts[user_id]
+                cart["items"] = [item for item in cart.get("items", []) if item["product"]["_id"] != product_id]
+
+    def start(self):
+        """Replay any journal left by the last shutdown and start the flush thread"""
+        self._replay_journal()
+
+        def run():
+            while not self._stop.wait(self.window / 2):
+                try:
+                    self.flush()
+                except Exception:
+                    pass  # already logged; the writes are retried on the next tick
+
+        self._thread = threading.Thread(target=run, name="cart-write-buffer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Flush everything; whatever cannot be written is journaled to disk"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        try:
+            self.flush(set(self._pending) | {entry[0] for entry in self._retry})
+        except Exception:
+            self._write_journal()
+
+    def _has_writes(self, user_id):
+        return (user_id in self._pending or user_id in self._flushing
+                or any(entry[0] == user_id for entry in self._retry))
+
+    def _unwritten(self, user_id):
+        return [deltas for u, _, deltas, _ in self._retry if u == user_id] + [self._pending.get(user_id, {})]
+
+    @staticmethod
+    def _is_retryable(error):
+        # Network errors and transient server errors; anything else would fail the same way again
+        if isinstance(error, ConnectionFailure):
+            return True
+        return isinstance(error, OperationFailure) and error.code in RETRYABLE_CODES
+
+    @staticmethod
+    def _apply(cart, product_id, delta, product):
+        """Apply a delta to a cart in place; returns the change actually made"""
+        items = cart.setdefault("items", [])
+        index = next((i for i, item in enumerate(items) if item["product"]["_id"] == product_id), None)
+        if index is None:
+            if delta > 0 and product:
+                items.append({"product": product, "quantity": delta})
+                return delta
+            return 0
+        if items[index]["quantity"] + delta > 0:
+            items[index]["quantity"] += delta
+            return delta
+        return -items.pop(index)["quantity"]
+
+    def _without_deleted_products(self, entries):
+        # Another worker may have deleted a product this one is about to add
+        added = {pid for _, _, deltas, _ in entries for pid, entry in deltas.items() if entry["delta"] > 0 and entry["product"]}
+        if not added:
+            return entries
+        existing = {
+            str(product["_id"]) for product in self.products_collection.find(
+                {"_id": {"$in": [ObjectId(pid) for pid in added if ObjectId.is_valid(pid)]}}, {"_id": 1}
+            )
+        }
+        kept = []
+        for user_id, fid, deltas, attempts in entries:
+            deltas = {pid: entry for pid, entry in deltas.items() if pid not in added or pid in existing}
+            if deltas:
+                kept.append((user_id, fid, deltas, attempts))
+        return kept
+
+    @staticmethod
+    def _operation(user_id, flush_id, deltas):
+        """One pipeline update applying all of a user's deltas to the stored cart"""
+        stages = [{"$set": {"items": {"$ifNull": ["$items", []]}}}]
+        for product_id, entry in deltas.items():
+            delta = entry["delta"]
+            if delta == 0:
+                continue
+            bumped = {"$map": {"input": "$items", "as": "item", "in": {"$cond": [
+                {"$eq": ["$$item.product._id", product_id]},
+                {"$mergeObjects": ["$$item", {"quantity": {"$add": ["$$item.quantity", delta]}}]},
+                "$$item"
+            ]}}}
+            appended = "$items"
+            if delta > 0 and entry["product"]:
+                appended = {"$concatArrays": ["$items", [{"$literal": {"product": entry["product"], "quantity": delta}}]]}
+            stages.append({"$set": {"items": {"$cond": [{"$in": [product_id, "$items.product._id"]}, bumped, appended]}}})
+        stages.append({"$set": {
+            "items": {"$filter": {"input": "$items", "as": "item", "cond": {"$gt": ["$$item.quantity", 0]}}},
+            "revision": {"$add": [{"$ifNull": ["$revision", 0]}, 1]},
+            "flush_ids": {"$slice": [{"$concatArrays": [{"$ifNull": ["$flush_ids", []]}, [flush_id]]}, -FLUSH_ID_HISTORY]}
+        }})
+        # Carts that already took this flush id do not match, so retries are no-ops
+        return UpdateOne({"user_id": user_id, "flush_ids": {"$ne": flush_id}}, stages)
+
+    def _write_journal(self):
+        with self._cond:
+            state = {"pending": self._pending, "retry": self._retry}
+        if not state["pending"] and not state["retry"]:
+            return
+        # One JSON line per worker, so several workers can share the journal
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps(state) + "\n")
+        logger.warning(f"Saved buffered cart writes to {self.journal_path}")
+
+    def _replay_journal(self):
+        # Claim the journal first so only one worker replays it
+        claimed = f"{self.journal_path}.{os.getpid()}"
+        try:
+            os.rename(self.journal_path, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed) as journal, self._cond:
+            for line in journal:
+                state = json.loads(line)
+                for user_id, deltas in state["pending"].items():
+                    self._pending.setdefault(user_id, {})
+                    for product_id, entry in deltas.items():
+                        current = self._pending[user_id].setdefault(product_id, {"delta": 0, "product": entry["product"]})
+                        current["delta"] += entry["delta"]
+                        current["product"] = current["product"] or entry["product"]
+                    self._first_seen[user_id] = time.time() - self.window
+                # Journals written before attempts were counted hold 3-item entries
+                self._retry.extend((*entry[:3], entry[3] if len(entry) > 3 else 0) for entry in state["retry"])
+        os.remove(claimed)
+        logger.info(f"Replayed buffered cart writes from {self.journal_path}")
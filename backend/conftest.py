@@ -0,0 +1,5 @@
+# Lets the unit tests in tests/ import the backend modules (run: python -m pytest tests)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
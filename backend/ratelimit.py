@@ -0,0 +1,318 @@
+import math
+import os
+import threading
+import time
+import logging
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, jsonify, make_response
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Rate limit settings (tokens refill per second, burst = bucket capacity)
+USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '5'))
+USER_BURST = int(os.getenv('RATE_LIMIT_USER_BURST', '20'))
+IP_RATE = float(os.getenv('RATE_LIMIT_IP_RATE', '10'))
+IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', '40'))
+
+# Concurrency settings: per worker with ConcurrencyLimiter, across all workers with MongoConcurrencyLimiter
+MAX_IN_FLIGHT = int(os.getenv('LOAD_SHED_MAX_IN_FLIGHT', '32'))
+MAX_QUEUE = int(os.getenv('LOAD_SHED_MAX_QUEUE', '64'))
+QUEUE_TIMEOUT = float(os.getenv('LOAD_SHED_QUEUE_TIMEOUT', '2'))
+# A shared slot whose holder died is reclaimed after this long
+SLOT_LEASE_SECONDS = float(os.getenv('LOAD_SHED_SLOT_LEASE', '60'))
+
+# Upper bound on in-process buckets (one per key, e.g. per email or IP)
+MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MAX_BUCKETS', '100000'))
+
+
+class MemoryBucketStore:
+    """Token buckets kept in this process (one set per worker), at most max_buckets of them"""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()   # key -> (tokens, updated_at, rate, capacity), least recent first
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity, now=None):
+        """Take one token from a bucket; returns (allowed, retry_after_seconds)"""
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated_at, _, _ = self._buckets.pop(key, (capacity, now, rate, capacity))
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, rate, capacity)
+            if len(self._buckets) > self.max_buckets:
+                self._evict(now)
+        return allowed, _retry_after(tokens, rate, allowed)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now):
+        # A bucket that has refilled to capacity behaves exactly like a new one
+        for key, (tokens, updated_at, rate, capacity) in list(self._buckets.items()):
+            if tokens + (now - updated_at) * rate >= capacity:
+                del self._buckets[key]
+        # Still full (e.g. a flood of made-up keys): drop the least recently used,
+        # leaving headroom so the sweep does not run on every request
+        while len(self._buckets) > self.max_buckets * 0.9:
+            self._buckets.popitem(last=False)
+
+
+class MongoBucketStore:
+    """Token buckets shared by every worker through a MongoDB collection"""
+
+    def __init__(self, collection, idle_ttl=3600):
+        self.collection = collection
+        self.collection.create_index("expires_at", expireAfterSeconds=idle_ttl)
+
+    def consume(self, key, rate, capacity, now=None):
+        """Take one token from a bucket; returns (allowed, retry_after_seconds)"""
+        now = time.time() if now is None else now
+        # Refill and take a token in one atomic pipeline update
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [
+                        {"$ifNull": ["$tokens", capacity]},
+                        {"$multiply": [rate, {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}]}
+                    ]}]},
+                    "updated_at": now,
+                    # Idle buckets are removed by the TTL index on expires_at
+                    "expires_at": "$$NOW"
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return bucket["allowed"], _retry_after(bucket["tokens"], rate, bucket["allowed"])
+
+
+def _retry_after(tokens, rate, allowed):
+    if allowed or rate <= 0:
+        return 0
+    return max(1, math.ceil((1 - tokens) / rate))
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight requests in this process and sheds new ones once the wait queue is full.
+
+    The cap is per worker: with gunicorn's default sync workers each process
+    serves one request at a time, so it only has an effect with threaded
+    (gthread) workers. Use MongoConcurrencyLimiter for a cap across workers.
+    """
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Returns True once a slot is held, False if the request should be shed"""
+        with self._cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self.in_flight < self.max_in_flight, self.queue_timeout):
+                    return False
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, slot=True):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+class MongoConcurrencyLimiter:
+    """Caps in-flight requests across every worker with leased slot documents.
+
+    Each of the max_in_flight slots is one document; a request takes a free
+    (or expired) slot atomically and frees it when done. A worker that dies
+    holding a slot loses it once its lease runs out. Waiting requests poll
+    for a slot, and the wait queue (max_queue) is counted per worker.
+    """
+
+    def __init__(self, collection, max_in_flight, max_queue, queue_timeout, lease=SLOT_LEASE_SECONDS):
+        self.collection = collection
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.lease = lease
+        self.waiting = 0
+        self._lock = threading.Lock()
+        for slot_id in range(max_in_flight):
+            self.collection.update_one({"_id": slot_id}, {"$setOnInsert": {"holder": None, "lease_until": 0}}, upsert=True)
+
+    @property
+    def in_flight(self):
+        return self.collection.count_documents({"_id": {"$lt": self.max_in_flight}, "lease_until": {"$gt": time.time()}})
+
+    def acquire(self):
+        """Returns the held slot once one is free, or None if the request should be shed"""
+        try:
+            slot = self._take()
+            if slot:
+                return slot
+            with self._lock:
+                if self.waiting >= self.max_queue:
+                    return None
+                self.waiting += 1
+            try:
+                deadline = time.time() + self.queue_timeout
+                delay = 0.01
+                while time.time() < deadline:
+                    time.sleep(min(delay, max(0, deadline - time.time())))
+                    slot = self._take()
+                    if slot:
+                        return slot
+                    delay = min(delay * 2, 0.25)
+                return None
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        except Exception as e:
+            # Fail open: a broken limiter must not take the API down
+            logger.error(f"Concurrency slot check failed: {str(e)}")
+            return True
+
+    def release(self, slot):
+        if not isinstance(slot, tuple):
+            return
+        slot_id, holder = slot
+        try:
+            # Only free the slot if our lease was not reclaimed meanwhile
+            self.collection.update_one({"_id": slot_id, "holder": holder}, {"$set": {"holder": None, "lease_until": 0}})
+        except Exception as e:
+            logger.error(f"Failed to free concurrency slot {slot_id}: {str(e)}")
+
+    def _take(self):
+        now = time.time()
+        holder = uuid.uuid4().hex
+        doc = self.collection.find_one_and_update(
+            {"_id": {"$lt": self.max_in_flight}, "lease_until": {"$lte": now}},
+            {"$set": {"holder": holder, "lease_until": now + self.lease}},
+            projection={"_id": 1}
+        )
+        return (doc["_id"], holder) if doc else None
+
+
+class LoadShedder:
+    """Per-user/per-IP token buckets plus a concurrency limit for a Flask app.
+
+    Both are pluggable: pass MongoBucketStore/MongoConcurrencyLimiter to
+    share them between workers, otherwise they are kept per process.
+    """
+
+    def __init__(self, store=None, concurrency=None, max_in_flight=MAX_IN_FLIGHT, max_queue=MAX_QUEUE,
+                 queue_timeout=QUEUE_TIMEOUT):
+        self.store = store or MemoryBucketStore()
+        self.concurrency = concurrency or ConcurrencyLimiter(max_in_flight, max_queue, queue_timeout)
+        self.shed = {"rate_limited_user": 0, "rate_limited_ip": 0, "overloaded": 0}
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register the concurrency limit around every request"""
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def stats(self):
+        """Number of shed requests by reason, plus current load"""
+        with self._stats_lock:
+            shed = dict(self.shed)
+        return {
+            "shed": shed,
+            "total_shed": sum(shed.values()),
+            "in_flight": self.concurrency.in_flight,
+            "queued": self.concurrency.waiting
+        }
+
+    def _record_shed(self, reason):
+        with self._stats_lock:
+            self.shed[reason] += 1
+
+    def _before_request(self):
+        if request.method == 'OPTIONS':
+            return None
+        slot = self.concurrency.acquire()
+        if not slot:
+            self._record_shed("overloaded")
+            logger.warning(f"Shedding {request.method} {request.path}: server overloaded")
+            return _reject("Server is busy, please retry shortly", 503, max(1, math.ceil(self.concurrency.queue_timeout)))
+        request.environ['ratelimit.slot'] = slot
+        return None
+
+    def _teardown_request(self, exc):
+        slot = request.environ.pop('ratelimit.slot', None)
+        if slot:
+            self.concurrency.release(slot)
+
+    def limit(self, user_key=None, user_rate=USER_RATE, user_burst=USER_BURST, ip_rate=IP_RATE, ip_burst=IP_BURST):
+        """Route decorator applying per-IP and (optionally) per-user token buckets.
+
+        user_key is called inside the request and returns the user identifier,
+        or None when the request carries no user.
+        """
+        def decorator(func):
+            @wraps(func)
+            def rate_limit_wrapper(*args, **kwargs):
+                checks = [("ip", f"ip:{request.remote_addr}:{func.__name__}", ip_rate, ip_burst)]
+                user_id = user_key() if user_key else None
+                if user_id:
+                    checks.append(("user", f"user:{user_id}:{func.__name__}", user_rate, user_burst))
+
+                for scope, key, rate, burst in checks:
+                    try:
+                        allowed, retry_after = self.store.consume(key, rate, burst)
+                    except Exception as e:
+                        # Fail open: a broken limiter must not take the API down
+                        logger.error(f"Rate limit check failed for {key}: {str(e)}")
+                        continue
+                    if not allowed:
+                        self._record_shed(f"rate_limited_{scope}")
+                        return _reject("Too many requests, please slow down", 429, retry_after)
+
+                return func(*args, **kwargs)
+            return rate_limit_wrapper
+        return decorator
+
+
+def _reject(message, status, retry_after):
+    response = make_response(jsonify({"success": False, "error": message}), status)
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def user_from_body():
+    """user_id from the JSON body (cart write routes)"""
+    data = request.get_json(silent=True) or {}
+    return data.get('user_id')
+
+
+def user_from_args():
+    """user_id from the query string (cart read route)"""
+    return request.args.get('user_id')
+
+
+def email_from_body():
+    """Email from the JSON body (auth routes, before a user id exists)"""
+    data = request.get_json(silent=True) or {}
+    return data.get('email')
@@ -0,0 +1,204 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from array import array
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+# Number of neighbors kept per product and how often web workers reload the snapshot
+TOP_K = int(os.getenv('RECOMMENDATIONS_TOP_K', '10'))
+RELOAD_SECONDS = int(os.getenv('RECOMMENDATIONS_RELOAD_SECONDS', '300'))
+CART_BATCH_SIZE = 10000
+
+
+def top_k_cooccurrence(cart_rows, item_cols, n_items, k):
+    """Top-k co-occurring items for every item.
+
+    cart_rows/item_cols hold one entry per (cart, item) pair. Returns
+    CSR-style (indptr, neighbors, counts): the neighbors of item i are
+    neighbors[indptr[i]:indptr[i + 1]], most frequent first.
+    """
+    n_carts = int(cart_rows.max()) + 1 if len(cart_rows) else 0
+    baskets = sparse.csr_matrix(
+        (np.ones(len(cart_rows), dtype=np.int32), (cart_rows, item_cols)),
+        shape=(n_carts, n_items)
+    )
+    # An item listed twice in one cart still counts once
+    baskets.data[:] = 1
+
+    # Item-item co-occurrence counts, without self pairs
+    co = (baskets.T @ baskets).tocsr()
+    co.setdiag(0)
+    co.eliminate_zeros()
+
+    # Sort each row by count (ties by item index) and keep the first k
+    row_lengths = np.diff(co.indptr)
+    rows = np.repeat(np.arange(n_items), row_lengths)
+    order = np.lexsort((co.indices, -co.data, rows))
+    rank = np.arange(len(order)) - co.indptr[rows]
+    keep = order[rank < k]
+
+    indptr = np.zeros(n_items + 1, dtype=np.int64)
+    np.cumsum(np.minimum(row_lengths, k), out=indptr[1:])
+    return indptr, co.indices[keep], co.data[keep]
+
+
+def build_neighbors(carts, products, k=TOP_K):
+    """product_id -> top-k [{"product": ..., "score": ...}] from cart and product documents"""
+    products = [dict(product, _id=str(product["_id"])) for product in products]
+    position = {product["_id"]: i for i, product in enumerate(products)}
+
+    # Stream carts into flat (cart, item) index arrays
+    cart_rows, item_cols = array('i'), array('i')
+    n_carts = 0
+    for cart in carts:
+        items = [position.get(str(item.get("product", {}).get("_id"))) for item in cart.get("items", [])]
+        items = [i for i in items if i is not None]
+        # Single-item carts carry no co-occurrence signal
+        if len(items) < 2:
+            continue
+        cart_rows.extend([n_carts] * len(items))
+        item_cols.extend(items)
+        n_carts += 1
+
+    indptr, neighbors, counts = top_k_cooccurrence(
+        np.frombuffer(cart_rows, dtype=np.int32) if cart_rows else np.zeros(0, dtype=np.int32),
+        np.frombuffer(item_cols, dtype=np.int32) if item_cols else np.zeros(0, dtype=np.int32),
+        len(products),
+        k
+    )
+
+    index = {}
+    for i, product in enumerate(products):
+        start, end = indptr[i], indptr[i + 1]
+        if start == end:
+            continue
+        index[product["_id"]] = [
+            {"product": products[j], "score": int(count)}
+            for j, count in zip(neighbors[start:end].tolist(), counts[start:end].tolist())
+        ]
+    logger.info(f"Built recommendations for {len(index)} products from {n_carts} carts")
+    return index
+
+
+class RecommendationIndex:
+    """Frequently-bought-together lists, built by a batch job and served from memory.
+
+    `python recommendations.py build` scans the carts and saves a snapshot
+    (one document per product) to the recommendations collection. Web
+    workers only load that snapshot; they never read the carts collection.
+    """
+
+    def __init__(self, collection, top_k=TOP_K):
+        self.collection = collection
+        self.top_k = top_k
+        self._neighbors = {}
+        self.loaded_at = None
+
+    def get(self, product_id, limit=None):
+        """Precomputed recommendations for a product (never queries the database)"""
+        return self._neighbors.get(product_id, [])[:limit or self.top_k]
+
+    def discard(self, product_id):
+        """Drop a deleted product from memory and from the saved snapshot"""
+        self._neighbors = {
+            pid: [rec for rec in recs if rec["product"]["_id"] != product_id]
+            for pid, recs in self._neighbors.items() if pid != product_id
+        }
+        self.collection.delete_one({"_id": product_id})
+        self.collection.update_many(
+            {"recommendations.product._id": product_id},
+            {"$pull": {"recommendations": {"product._id": product_id}}}
+        )
+
+    def load(self):
+        """Replace the in-memory lists with the saved snapshot"""
+        self._neighbors = {doc["_id"]: doc["recommendations"] for doc in self.collection.find()}
+        self.loaded_at = time.time()
+
+    def save(self, neighbors):
+        """Swap in a new snapshot; readers see either the old or the new one"""
+        staging = self.collection.database[f"{self.collection.name}_staging"]
+        staging.drop()
+        if neighbors:
+            staging.insert_many(
+                [{"_id": pid, "recommendations": recs} for pid, recs in neighbors.items()],
+                ordered=False
+            )
+            staging.rename(self.collection.name, dropTarget=True)
+        else:
+            self.collection.delete_many({})
+        self._neighbors = neighbors
+
+    def start(self, interval=RELOAD_SECONDS):
+        """Load the snapshot now and then every `interval` seconds on a background thread"""
+        def reload():
+            while True:
+                try:
+                    self.load()
+                except Exception as e:
+                    logger.error(f"Error loading recommendations: {str(e)}")
+                time.sleep(interval)
+
+        thread = threading.Thread(target=reload, name="recommendations-reload", daemon=True)
+        thread.start()
+        return thread
+
+
+def rebuild(db, top_k=TOP_K):
+    """Batch job: build from the carts collection and save the snapshot"""
+    started = time.perf_counter()
+    products = db.products.find({}, {"name": 1, "price": 1, "image": 1})
+    carts = db.carts.find({}, {"items.product._id": 1, "_id": 0}).batch_size(CART_BATCH_SIZE)
+    neighbors = build_neighbors(carts, products, top_k)
+    RecommendationIndex(db.recommendations, top_k).save(neighbors)
+    logger.info(f"Saved recommendations snapshot in {time.perf_counter() - started:.2f}s")
+
+
+def benchmark(n_carts, n_products, items_per_cart, k, seed=0):
+    """Time a full rebuild (cart documents -> top-k lists) on synthetic carts with skewed popularity"""
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 2 * items_per_cart, size=n_carts)
+    popularity = 1.0 / np.arange(1, n_products + 1)
+    popularity /= popularity.sum()
+    picks = rng.choice(n_products, size=int(sizes.sum()), p=popularity).tolist()
+
+    # Cart documents shaped like the projected cursor results; item dicts are shared to save memory
+    products = [{"_id": f"{i:024x}", "name": f"Product {i}", "price": 1.0, "image": ""} for i in range(n_products)]
+    lines = [{"product": {"_id": product["_id"]}} for product in products]
+    carts, start = [], 0
+    for size in sizes.tolist():
+        carts.append({"items": [lines[i] for i in picks[start:start + size]]})
+        start += size
+
+    started = time.perf_counter()
+    neighbors = build_neighbors(carts, products, k)
+    elapsed = time.perf_counter() - started
+    print(f"{n_carts} carts, {n_products} products, {len(picks)} cart lines: "
+          f"built top-{k} for {len(neighbors)} products in {elapsed:.2f}s")
+    return elapsed
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--top-k", type=int, default=TOP_K)
+    parser = argparse.ArgumentParser(description="Build or benchmark the recommendation snapshot")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", parents=[common], help="rebuild from the carts collection and save the snapshot")
+    bench = commands.add_parser("bench", parents=[common], help="time a rebuild on synthetic carts")
+    bench.add_argument("--carts", type=int, default=1000000)
+    bench.add_argument("--products", type=int, default=5000)
+    bench.add_argument("--items-per-cart", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from database import get_db
+        rebuild(get_db(), args.top_k)
+    else:
+        benchmark(args.carts, args.products, args.items_per_cart, args.top_k)
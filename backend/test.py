@@ -1,7 +1,9 @@
 import requests
 import json
+import time
 
 BASE_URL = "http://localhost:5000/api"
+SYNC_TEST_USER = "sync-test-user@gmail.com"
 
 # Test adding a product
 def test_add_product():
@@ -28,6 +30,16 @@ def test_get_products():
         print("❌ Get products: Failed")
         return []
 
+# Test getting recommendations for a product
+def test_get_recommendations(product_id):
+    response = requests.get(f"{BASE_URL}/products/{product_id}/recommendations")
+    if response.status_code == 200 and "recommendations" in response.json():
+        print("✅ Get recommendations: Success")
+        return True
+    else:
+        print("❌ Get recommendations: Failed")
+        return False
+
 # Test adding to cart
 def test_add_to_cart(product_id):
     cart_data = {"product_id": product_id}
@@ -60,6 +72,65 @@ def test_remove_from_cart(product_id):
         print("❌ Remove from cart: Failed")
         return False
 
+# Test syncing a client-side cart
+def test_sync_cart(product_id):
+    headers = {"Authorization": "Bearer test-token"}
+    user_id = SYNC_TEST_USER
+    unknown_id = "0" * 24
+
+    response = requests.get(f"{BASE_URL}/cart", params={"user_id": user_id}, headers=headers)
+    if response.status_code != 200:
+        print("❌ Sync cart: Failed (could not read cart)")
+        return False
+    start_revision = response.json()["cart"].get("revision", 0)
+
+    # Guest cart (no revision): unknown products come back as removed, known ones are kept
+    sync_data = {
+        "user_id": user_id,
+        "items": [{"product_id": product_id, "quantity": 2}, {"product_id": unknown_id, "quantity": 1}],
+        "revision": None
+    }
+    first = requests.post(f"{BASE_URL}/cart/sync", json=sync_data, headers=headers).json()
+
+    # Stale client with an empty cart: the stored line comes back as changed, no write happens
+    sync_data = {"user_id": user_id, "items": [], "revision": None}
+    second = requests.post(f"{BASE_URL}/cart/sync", json=sync_data, headers=headers).json()
+
+    # Guest cart merged at login: quantities are added, and a replay with the same sync_id is not
+    sync_data = {
+        "user_id": user_id,
+        "items": [{"product_id": product_id, "quantity": 1}],
+        "revision": None,
+        "merge": "sum",
+        "sync_id": f"sync-test-{time.time()}"
+    }
+    third = requests.post(f"{BASE_URL}/cart/sync", json=sync_data, headers=headers).json()
+    replay = requests.post(f"{BASE_URL}/cart/sync", json=sync_data, headers=headers).json()
+
+    ok = (
+        first.get("success")
+        and first["removed"] == [unknown_id]
+        and first["changed"] == []
+        and first["revision"] > start_revision
+        and second.get("success")
+        and [(line["product"]["_id"], line["quantity"]) for line in second["changed"]] == [(product_id, 2)]
+        and second["removed"] == []
+        and second["revision"] == first["revision"]
+        and third.get("success")
+        and [(line["product"]["_id"], line["quantity"]) for line in third["changed"]] == [(product_id, 3)]
+        and replay.get("success")
+        and [(line["product"]["_id"], line["quantity"]) for line in replay["changed"]] == [(product_id, 3)]
+        and replay["revision"] == third["revision"]
+    )
+    requests.post(f"{BASE_URL}/cart/clear", json={"user_id": user_id}, headers=headers)
+
+    if ok:
+        print("✅ Sync cart: Success")
+        return True
+    else:
+        print("❌ Sync cart: Failed")
+        return False
+
 # Test deleting product
 def test_delete_product(product_id):
     response = requests.delete(f"{BASE_URL}/products/{product_id}")
@@ -81,11 +152,13 @@ def run_tests():
         return
     
     products = test_get_products()
+    recommendations = test_get_recommendations(product_id)
     
     # Test cart functionality
     cart_add = test_add_to_cart(product_id)
     cart_get = test_get_cart()
     cart_remove = test_remove_from_cart(product_id)
+    cart_sync = test_sync_cart(product_id)
     
     # Clean up
     product_delete = test_delete_product(product_id)
@@ -93,9 +166,11 @@ def run_tests():
     print("\nTest Summary:")
     print(f"Products added: {product_id is not None}")
     print(f"Products retrieved: {len(products) > 0}")
+    print(f"Recommendations: {recommendations}")
     print(f"Cart add: {cart_add}")
     print(f"Cart get: {cart_get}")
     print(f"Cart remove: {cart_remove}")
+    print(f"Cart sync: {cart_sync}")
     print(f"Product delete: {product_delete}")
 
 if __name__ == "__main__":
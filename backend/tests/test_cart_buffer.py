@@ -0,0 +1,258 @@
+import threading
+import time
+
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from cart_buffer import CartWriteBuffer, MAX_FLUSH_ATTEMPTS
+
+P1 = str(ObjectId())
+P2 = str(ObjectId())
+
+
+class FakeCarts:
+    """Records bulk writes; fail_with makes the next one raise, block_on pauses the next one"""
+
+    def __init__(self):
+        self.writes = []
+        self.fail_with = None
+        self.block_on = None
+
+    def bulk_write(self, operations, ordered):
+        self.writes.append(operations)
+        if self.block_on:
+            event, self.block_on = self.block_on, None
+            event.wait()
+        if self.fail_with:
+            error, self.fail_with = self.fail_with, None
+            raise error
+
+
+def write_errors(*errors):
+    """BulkWriteError for (index, code) pairs"""
+    return BulkWriteError({
+        "writeErrors": [{"index": index, "code": code, "errmsg": "failed"} for index, code in errors],
+        "writeConcernErrors": []
+    })
+
+
+class FakeProducts:
+    def __init__(self, product_ids):
+        self.product_ids = set(product_ids)
+
+    def find(self, query, projection):
+        return [{"_id": oid} for oid in query["_id"]["$in"] if str(oid) in self.product_ids]
+
+
+def written(operations):
+    """(user_id, flush_id) of each operation in a bulk write"""
+    return [(op._filter["user_id"], op._filter["flush_ids"]["$ne"]) for op in operations]
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    return CartWriteBuffer(FakeCarts(), FakeProducts([P1, P2]), window=0, journal_path=str(tmp_path / "journal.json"))
+
+
+def load_cart(user_id):
+    return {"user_id": user_id, "items": [{"product": {"_id": P1}, "quantity": 1}], "revision": 3}
+
+
+def test_deltas_are_coalesced_into_one_write(buffer):
+    for _ in range(3):
+        cart = buffer.add("a", P1, 1, load_cart)
+    cart = buffer.add("a", P2, 1, load_cart, {"_id": P2})
+
+    assert [item["quantity"] for item in cart["items"]] == [4, 1]
+    buffer.flush()
+    assert len(buffer.collection.writes) == 1
+    assert [user for user, _ in written(buffer.collection.writes[0])] == ["a"]
+    assert buffer._pending == {}
+
+
+def test_reads_go_to_mongo_once_nothing_is_pending(buffer):
+    loads = []
+
+    def counting_load(user_id):
+        loads.append(user_id)
+        return load_cart(user_id)
+
+    buffer.get_cart("a", counting_load)
+    buffer.get_cart("a", counting_load)
+    assert len(loads) == 2
+
+    buffer.add("a", P1, 1, counting_load)
+    assert buffer.get_cart("a", counting_load)["items"][0]["quantity"] == 2
+    assert len(loads) == 3
+
+    buffer.flush()
+    buffer.get_cart("a", counting_load)
+    assert len(loads) == 4
+
+
+def test_decrement_of_missing_item_is_ignored(buffer):
+    cart = buffer.add("a", P2, -1, load_cart)
+    assert cart["items"] == [{"product": {"_id": P1}, "quantity": 1}]
+    assert buffer._pending == {}
+
+
+def test_partial_failure_requeues_only_failed_users(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    buffer.add("b", P1, 1, load_cart)
+    # 11602: interrupted by a replica set state change, safe to retry
+    buffer.collection.fail_with = write_errors((1, 11602))
+
+    with pytest.raises(BulkWriteError):
+        buffer.flush()
+    first = written(buffer.collection.writes[0])
+
+    buffer.flush()
+    # Only b is written again, under its original flush id
+    assert written(buffer.collection.writes[1]) == [first[1]]
+    assert buffer._retry == []
+
+
+def test_permanent_write_error_is_dropped_without_blocking_other_users(buffer):
+    buffer.add("bad", P1, 1, load_cart)
+    buffer.add("good", P1, 1, load_cart)
+    # 121: document failed validation, retrying cannot help
+    buffer.collection.fail_with = write_errors((0, 121))
+
+    buffer.flush()
+    assert buffer._retry == []
+    assert buffer.stats["dropped_writes"] == 1
+    # The stale view is released; reads go back to the stored cart
+    assert "bad" not in buffer._carts
+    assert buffer.get_cart("bad", load_cart)["items"][0]["quantity"] == 1
+
+    buffer.add("good", P1, 1, load_cart)
+    with buffer.hold("good"):
+        pass
+    assert [user for user, _ in written(buffer.collection.writes[-1])] == ["good"]
+
+
+def test_flush_of_one_user_ignores_other_users_failures(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+
+    buffer.add("b", P1, 1, load_cart)
+    buffer.flush(["b"])
+    assert [user for user, _ in written(buffer.collection.writes[1])] == ["b"]
+    assert [entry[0] for entry in buffer._retry] == ["a"]
+
+
+def test_writes_are_dropped_after_max_attempts(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    for _ in range(MAX_FLUSH_ATTEMPTS - 1):
+        buffer.collection.fail_with = AutoReconnect("connection reset")
+        with pytest.raises(AutoReconnect):
+            buffer.flush()
+
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+    buffer.flush()
+    assert buffer._retry == []
+    assert buffer.stats["dropped_writes"] == 1
+    assert len(buffer.collection.writes) == MAX_FLUSH_ATTEMPTS
+
+
+def test_overlapping_flushes_keep_the_view_until_both_finish(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    release = threading.Event()
+    buffer.collection.block_on = release
+    background = threading.Thread(target=buffer.flush)
+    background.start()
+    while not buffer.collection.writes:
+        time.sleep(0.001)
+
+    # A second flush of the same user finishes while the first is still writing
+    buffer.add("a", P1, 1, load_cart)
+    buffer.flush(["a"])
+    assert "a" in buffer._flushing
+    assert buffer.get_cart("a", load_cart)["items"][0]["quantity"] == 3
+
+    release.set()
+    background.join()
+    assert "a" not in buffer._flushing
+    assert "a" not in buffer._carts
+
+
+def test_unknown_outcome_retries_everything_with_same_flush_ids(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    buffer.add("b", P1, 1, load_cart)
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+    buffer.flush()
+
+    assert written(buffer.collection.writes[1]) == written(buffer.collection.writes[0])
+
+
+def test_pending_view_survives_failed_flush(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+    assert buffer.get_cart("a", load_cart)["items"][0]["quantity"] == 2
+
+
+def test_close_journals_unwritten_deltas_for_replay(buffer):
+    buffer.add("a", P1, 2, load_cart)
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+    buffer.close()
+    failed = written(buffer.collection.writes[0])
+
+    restarted = CartWriteBuffer(FakeCarts(), FakeProducts([P1]), window=0, journal_path=buffer.journal_path)
+    restarted._replay_journal()
+    # The replayed deltas show up in reads before they are written
+    assert restarted.get_cart("a", load_cart)["items"][0]["quantity"] == 3
+    restarted.flush()
+    assert written(restarted.collection.writes[0]) == failed
+
+
+def test_deleted_products_are_not_written(buffer):
+    buffer.products_collection = FakeProducts([P1])
+    buffer.add("a", P2, 1, load_cart, {"_id": P2})
+    buffer.flush()
+    assert buffer.collection.writes == []
+    assert buffer._pending == {}
+
+
+def test_discard_user_drops_pending_and_retried_writes(buffer):
+    buffer.add("a", P1, 1, load_cart)
+    buffer.collection.fail_with = AutoReconnect("connection reset")
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+    buffer.add("a", P1, 1, load_cart)
+
+    buffer.discard_user("a")
+    buffer.flush()
+    assert len(buffer.collection.writes) == 1
+    assert buffer.get_cart("a", load_cart)["items"][0]["quantity"] == 1
+
+
+def test_hold_flushes_and_delays_clicks_until_cart_is_rewritten(buffer):
+    stored = {"items": [{"product": {"_id": P1}, "quantity": 1}]}
+
+    def load_stored(user_id):
+        return {"user_id": user_id, "items": [dict(item) for item in stored["items"]]}
+
+    buffer.add("a", P1, 1, load_stored)
+    results = []
+    with buffer.hold("a"):
+        # The pending click was written before the caller reads the cart
+        assert len(buffer.collection.writes) == 1
+        clicker = threading.Thread(target=lambda: results.append(buffer.add("a", P1, 1, load_stored)))
+        clicker.start()
+        clicker.join(timeout=0.1)
+        assert clicker.is_alive()
+        # The caller rewrites the stored cart (as Cart.sync does)
+        stored["items"] = [{"product": {"_id": P1}, "quantity": 5}]
+    clicker.join()
+
+    # The held click is applied on top of the rewritten cart, not lost
+    assert results[0]["items"][0]["quantity"] == 6
+    assert buffer._pending["a"][P1]["delta"] == 1
@@ -0,0 +1,153 @@
+import threading
+
+from flask import Flask, jsonify
+
+from ratelimit import MemoryBucketStore, ConcurrencyLimiter, MongoConcurrencyLimiter, LoadShedder, user_from_body
+
+
+def test_bucket_allows_burst_then_rejects_with_retry_after():
+    store = MemoryBucketStore()
+    results = [store.consume("k", rate=0.5, capacity=3, now=0) for _ in range(4)]
+    assert results[:3] == [(True, 0)] * 3
+    # Empty bucket refilling at 0.5 tokens/s needs 2s for the next token
+    assert results[3] == (False, 2)
+    assert store.consume("k", rate=0.5, capacity=3, now=2) == (True, 0)
+
+
+def test_bucket_store_evicts_full_buckets_first():
+    store = MemoryBucketStore(max_buckets=10)
+    store.consume("busy", rate=1, capacity=5, now=0)
+    for i in range(10):
+        store.consume(f"email-{i}@gmail.com", rate=1, capacity=5, now=100)
+    # All buckets that refilled to capacity were dropped; "busy" was one of them
+    assert len(store) <= 10
+    assert store.consume("busy", rate=1, capacity=5, now=100) == (True, 0)
+
+
+def test_bucket_store_stays_bounded_under_key_flood():
+    store = MemoryBucketStore(max_buckets=100)
+    for i in range(1000):
+        store.consume(f"fake-{i}", rate=0.001, capacity=5, now=0)
+    assert len(store) <= 100
+
+
+def test_concurrency_limiter_sheds_when_queue_full():
+    limiter = ConcurrencyLimiter(max_in_flight=1, max_queue=0, queue_timeout=1)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+
+
+def test_concurrency_limiter_sheds_after_queue_timeout():
+    limiter = ConcurrencyLimiter(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.waiting == 0
+
+
+def test_concurrency_limiter_hands_slot_to_waiter():
+    limiter = ConcurrencyLimiter(max_in_flight=1, max_queue=1, queue_timeout=2)
+    assert limiter.acquire()
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    waiter.start()
+    limiter.release()
+    waiter.join()
+    assert results == [True]
+
+
+class FakeSlots:
+    """Just enough of a collection for MongoConcurrencyLimiter (one shared by several "workers")"""
+
+    def __init__(self):
+        self.docs = {}
+
+    def update_one(self, query, update, upsert=False):
+        doc = self.docs.get(query["_id"])
+        if doc is None and upsert:
+            self.docs[query["_id"]] = dict(update["$setOnInsert"], _id=query["_id"])
+        elif doc is not None and all(doc.get(k) == v for k, v in query.items()):
+            doc.update(update.get("$set", {}))
+
+    def find_one_and_update(self, query, update, projection):
+        for slot_id, doc in sorted(self.docs.items()):
+            if slot_id < query["_id"]["$lt"] and doc["lease_until"] <= query["lease_until"]["$lte"]:
+                doc.update(update["$set"])
+                return {"_id": slot_id}
+        return None
+
+    def count_documents(self, query):
+        return sum(1 for slot_id, doc in self.docs.items()
+                   if slot_id < query["_id"]["$lt"] and doc["lease_until"] > query["lease_until"]["$gt"])
+
+
+def test_shared_concurrency_limit_spans_workers():
+    slots = FakeSlots()
+    worker_a = MongoConcurrencyLimiter(slots, max_in_flight=2, max_queue=0, queue_timeout=1)
+    worker_b = MongoConcurrencyLimiter(slots, max_in_flight=2, max_queue=0, queue_timeout=1)
+
+    first, second = worker_a.acquire(), worker_a.acquire()
+    assert first and second
+    # The other worker sees the same two slots taken
+    assert worker_b.acquire() is None
+    assert worker_b.in_flight == 2
+
+    worker_a.release(first)
+    assert worker_b.acquire()
+
+
+def test_shared_slot_of_a_dead_worker_is_reclaimed_after_its_lease():
+    slots = FakeSlots()
+    dead = MongoConcurrencyLimiter(slots, max_in_flight=1, max_queue=0, queue_timeout=1, lease=0.01)
+    slot = dead.acquire()
+    assert slot
+
+    alive = MongoConcurrencyLimiter(slots, max_in_flight=1, max_queue=1, queue_timeout=1)
+    assert alive.acquire()
+    # The late release of the expired lease does not free the new holder's slot
+    dead.release(slot)
+    assert alive.in_flight == 1
+
+
+def make_app(shedder):
+    app = Flask(__name__)
+    shedder.init_app(app)
+
+    @app.route('/cart/add', methods=['POST'])
+    @shedder.limit(user_key=user_from_body, user_rate=0.1, user_burst=2, ip_rate=100, ip_burst=100)
+    def add():
+        return jsonify({"success": True}), 200
+
+    return app
+
+
+def test_rate_limited_route_returns_429_with_retry_after():
+    shedder = LoadShedder()
+    client = make_app(shedder).test_client()
+    statuses = [client.post('/cart/add', json={"user_id": "a@gmail.com"}).status_code for _ in range(2)]
+    response = client.post('/cart/add', json={"user_id": "a@gmail.com"})
+
+    assert statuses == [200, 200]
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert response.json == {"success": False, "error": "Too many requests, please slow down"}
+    # Another user is unaffected
+    assert client.post('/cart/add', json={"user_id": "b@gmail.com"}).status_code == 200
+    assert shedder.stats()["shed"]["rate_limited_user"] == 1
+
+
+def test_overloaded_server_returns_503_with_retry_after():
+    shedder = LoadShedder(max_in_flight=1, max_queue=0, queue_timeout=1)
+    client = make_app(shedder).test_client()
+    # Occupy the only slot, as a slow request would
+    assert shedder.concurrency.acquire()
+
+    response = client.post('/cart/add', json={"user_id": "a@gmail.com"})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert shedder.stats()["shed"]["overloaded"] == 1
+
+    shedder.concurrency.release()
+    assert client.post('/cart/add', json={"user_id": "a@gmail.com"}).status_code == 200
+    assert shedder.concurrency.in_flight == 0
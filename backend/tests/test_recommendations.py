@@ -0,0 +1,51 @@
+import numpy as np
+
+from recommendations import top_k_cooccurrence, build_neighbors
+
+
+def neighbors_of(indptr, neighbors, counts, item):
+    start, end = indptr[item], indptr[item + 1]
+    return list(zip(neighbors[start:end].tolist(), counts[start:end].tolist()))
+
+
+def test_top_k_orders_by_count_then_item_index():
+    # Item 0 appears with 1 twice, with 2 twice and with 3 once
+    carts = [[0, 1], [0, 1], [0, 2], [0, 2, 3]]
+    rows = np.array([c for c, items in enumerate(carts) for _ in items], dtype=np.int32)
+    cols = np.array([i for items in carts for i in items], dtype=np.int32)
+
+    indptr, neighbors, counts = top_k_cooccurrence(rows, cols, n_items=4, k=2)
+
+    # Tie between 1 and 2 goes to the lower index; 3 falls outside the top 2
+    assert neighbors_of(indptr, neighbors, counts, 0) == [(1, 2), (2, 2)]
+    assert neighbors_of(indptr, neighbors, counts, 3) == [(0, 1), (2, 1)]
+    assert neighbors_of(indptr, neighbors, counts, 1) == [(0, 2)]
+
+
+def test_top_k_counts_duplicate_lines_once():
+    rows = np.array([0, 0, 0], dtype=np.int32)
+    cols = np.array([0, 1, 1], dtype=np.int32)
+    indptr, neighbors, counts = top_k_cooccurrence(rows, cols, n_items=2, k=5)
+    assert neighbors_of(indptr, neighbors, counts, 0) == [(1, 1)]
+    assert neighbors_of(indptr, neighbors, counts, 1) == [(0, 1)]
+
+
+def test_build_neighbors_from_cart_documents():
+    products = [{"_id": pid, "name": pid} for pid in ("a", "b", "c")]
+    carts = [
+        {"items": [{"product": {"_id": "a"}}, {"product": {"_id": "b"}}]},
+        {"items": [{"product": {"_id": "a"}}, {"product": {"_id": "deleted"}}]},
+        {"items": [{"product": {"_id": "c"}}]},
+        {"items": []},
+    ]
+
+    index = build_neighbors(carts, products, k=3)
+
+    assert index == {
+        "a": [{"product": {"_id": "b", "name": "b"}, "score": 1}],
+        "b": [{"product": {"_id": "a", "name": "a"}, "score": 1}],
+    }
+
+
+def test_build_neighbors_without_carts():
+    assert build_neighbors([], [{"_id": "a"}], k=3) == {}
@@ -3,11 +3,17 @@ import { useRouter } from 'next/router';
 import axios from 'axios';
 import Head from 'next/head';
 import styles from '../styles/Cart.module.css';
+import { productAPI } from '../utils/api';
+
+// How many cart items to look up, and how many suggestions to show
+const RECOMMENDATION_SOURCES = 3;
+const RECOMMENDATION_COUNT = 4;
 
 const Cart = () => {
   const [cart, setCart] = useState({ items: [] });
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
+  const [recommendations, setRecommendations] = useState([]);
   const router = useRouter();
 
   // Get current user ID from localStorage
@@ -224,6 +230,29 @@ const Cart = () => {
     }
   };
 
+  // Fetch "frequently bought together" products for the first few cart items
+  const fetchRecommendations = async (items) => {
+    const inCart = new Set(items.map(item => item.product._id));
+    const sources = items.slice(0, RECOMMENDATION_SOURCES);
+    const responses = await Promise.all(
+      sources.map(item => productAPI.getRecommendations(item.product._id, RECOMMENDATION_COUNT).catch(() => null))
+    );
+    
+    // Combine the lists, adding up scores of products suggested more than once
+    const merged = {};
+    responses.forEach(response => {
+      (response?.data?.recommendations || []).forEach(({ product, score }) => {
+        if (inCart.has(product._id)) return;
+        merged[product._id] = merged[product._id]
+          ? { product, score: merged[product._id].score + score }
+          : { product, score };
+      });
+    });
+    setRecommendations(
+      Object.values(merged).sort((a, b) => b.score - a.score).slice(0, RECOMMENDATION_COUNT)
+    );
+  };
+
   // Handle checkout process
   const handleCheckout = () => {
     router.push('/checkout');
@@ -246,6 +275,15 @@ const Cart = () => {
     }
   }, []);
 
+  // Refresh suggestions whenever the cart changes
+  useEffect(() => {
+    if (cart.items.length > 0) {
+      fetchRecommendations(cart.items);
+    } else {
+      setRecommendations([]);
+    }
+  }, [cart.items]);
+
   // Format price with commas for thousands
   const formatPrice = (price) => {
     return parseFloat(price).toLocaleString('en-US', {
@@ -427,6 +465,28 @@ const Cart = () => {
                 </button>
               </div>
             </div>
+
+            {recommendations.length > 0 && (
+              <div className={styles.recommendations}>
+                <h2 className={styles.recommendationsTitle}>Frequently Bought Together</h2>
+                <div className={styles.recommendationGrid}>
+                  {recommendations.map(({ product }) => (
+                    <div key={product._id} className={styles.recommendationCard}>
+                      <img src={product.image} alt={product.name} />
+                      <div className={styles.recommendationName}>{product.name}</div>
+                      <div className={styles.recommendationPrice}>${formatPrice(product.price)}</div>
+                      <button
+                        className={styles.secondaryButton}
+                        onClick={() => addItem(product._id)}
+                        disabled={loading}
+                      >
+                        Add to Cart
+                      </button>
+                    </div>
+                  ))}
+                </div>
+              </div>
+            )}
           </>
         )}
       </div>
@@ -483,6 +483,20 @@ useEffect(() => {
 const handleAddToCart = async (productId) => {
   // Check if user is logged in
   if (!isLoggedIn) {
+    // Remember the item so it is added to the account cart at login
+    const guestCart = JSON.parse(localStorage.getItem('guestCart') || '[]');
+    const line = guestCart.find(item => item.product_id === productId);
+    if (line) {
+      line.quantity += 1;
+    } else {
+      guestCart.push({ product_id: productId, quantity: 1 });
+    }
+    localStorage.setItem('guestCart', JSON.stringify(guestCart));
+    // One id per guest cart, so a retried merge is not added twice
+    if (!localStorage.getItem('guestCartId')) {
+      localStorage.setItem('guestCartId', `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`);
+    }
+    
     // Redirect to login page instead of showing modal
     router.push('/login');
     return;
@@ -1,7 +1,7 @@
 'use client';
 import { useState } from 'react';
 import { useRouter } from 'next/navigation';
-import { authAPI } from '../utils/api';
+import { authAPI, cartAPI } from '../utils/api';
 import styles from './Register.module.css';
 
 const Login = () => {
@@ -87,6 +87,19 @@ const Login = () => {
         
         localStorage.setItem('user', JSON.stringify(userData));
         
+        // Merge any guest cart into the account cart in a single request
+        const guestCart = localStorage.getItem('guestCart');
+        if (guestCart) {
+          try {
+            // No revision and merge 'sum': the guest's items are added to the account cart
+            await cartAPI.sync(JSON.parse(guestCart), null, 'sum', localStorage.getItem('guestCartId'));
+            localStorage.removeItem('guestCart');
+            localStorage.removeItem('guestCartId');
+          } catch (err) {
+            console.error('Failed to sync guest cart:', err);
+          }
+        }
+        
         setSuccess('Login successful! Redirecting...');
         setTimeout(() => router.push('/'), 2000);
       } else {
@@ -55,6 +55,8 @@ export const productAPI = {
   delete: (id) => api.delete(`/products/${id}`),
   search: (term) => api.get(`/products/search?q=${term}`),
   uploadImage: (formData) => api.post('/upload', formData),
+  // "Frequently bought together" products, used by the cart page
+  getRecommendations: (id, limit = 10) => api.get(`/products/${id}/recommendations?limit=${limit}`),
 };
 
 // Cart API endpoints
@@ -75,6 +77,12 @@ export const cartAPI = {
     const userId = getUserIdFromLocalStorage();
     return api.post('/cart/clear', { user_id: userId });
   },
+  // Merge a local cart ([{ product_id, quantity }]) in one request; returns only the changed lines.
+  // merge: 'max' for a stale copy of this cart, 'sum' to add a guest cart; syncId makes a retry safe
+  sync: (items, revision = null, merge = 'max', syncId = null) => {
+    const userId = getUserIdFromLocalStorage();
+    return api.post('/cart/sync', { user_id: userId, items, revision, merge, sync_id: syncId });
+  },
   checkout: (paymentInfo) => api.post('/cart/checkout', paymentInfo),
 };
 